@@ -13,6 +13,12 @@ fi
 
 cd "$PROJECT_DIR" || { echo "Failed to enter directory"; exit 1; }
 
+# --- 2b. Local settings: config.json is untracked so updates never touch it ---
+if [ ! -f "config.json" ]; then
+    echo "Creating config.json from config.json.example..."
+    cp config.json.example config.json
+fi
+
 # --- 3. Hardware Setup: Enable UART5 ---
 echo "Enabling UART5 hardware overlay..."
 if ! grep -q "overlays=uart5" /boot/orangepiEnv.txt; then
@@ -34,7 +40,7 @@ python3 -m venv venv
 echo "Installing Python requirements..."
 # Ensure requirements.txt uses 'paho-mqtt', NOT 'python3-paho-mqtt'
 ./venv/bin/pip install --upgrade pip
-./venv/bin/pip install flask flask-cors pyserial paho-mqtt requests
+./venv/bin/pip install flask flask-cors pyserial paho-mqtt requests waitress
 
 # --- 7. Install Systemd Service ---
 echo "Installing LidarCounter Service..."
@@ -1,58 +1,378 @@
 import subprocess
 import os
+import shutil
+import fcntl
+import sys
+import time
+import threading
+import hashlib
+import inspect
 import logging
 
-# Configure logging to match your app.py style
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+# libgit2 bindings are optional: when present, the ref checks and reset run
+# in-process instead of forking git; otherwise fall back to the git CLI
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
 
-def check_for_updates():
-    # Update this path to your Orange Pi Zero 2 project directory
-    PROJECT_DIR = '/root/LidarCounter-Orangepi'
-    SERVICE_NAME = 'LidarCounter.service'
-    
+# Errors from a pygit2 call that send us to the git CLI instead. Besides libgit2
+# failures this covers API drift between pygit2 releases (renamed attributes,
+# changed signatures), so an upgrade or downgrade never breaks updates
+PYGIT2_ERRORS = (pygit2.GitError, KeyError, AttributeError, TypeError) if pygit2 is not None else ()
+
+# Logging is configured by whoever runs us (app.py, or __main__ below)
+logger = logging.getLogger(__name__)
+
+# Update this path to your Orange Pi Zero 2 project directory
+PROJECT_DIR = '/root/LidarCounter-Orangepi'
+SERVICE_NAME = 'LidarCounter.service'
+BRANCH = 'main'
+
+# Updater state lives in a root-owned directory, not world-writable /tmp where
+# a planted symlink could redirect our O_CREAT/utime as root
+STATE_DIR = '/var/lib/lidarcounter'
+
+# A completed check is remembered for this long; the marker's mtime carries it
+# across runs (cron, timers), so back-to-back calls skip the network entirely
+CHECK_INTERVAL_SEC = 300
+LAST_CHECK_FILE = os.path.join(STATE_DIR, 'last_check')
+LOCK_FILE = os.path.join(STATE_DIR, 'updater.lock')
+
+# Background checks back off exponentially after failures, up to this cap
+MAX_BACKOFF_SEC = 3600
+
+# Local settings. Both are untracked (see config.json.example), so a reset
+# should leave them alone; the in-memory copy is only a safety net. A checkout
+# that loses config.json anyway gets it recreated from the example by app.py
+PRESERVED_FILES = ('config.json', 'schedule.json')
+
+# Digest of the requirements.txt last installed successfully; pip only runs
+# when the file actually changed
+REQUIREMENTS_HASH_FILE = os.path.join(STATE_DIR, 'requirements.hash')
+
+_repo = None
+
+def open_repo():
+    # Opened once and reused, so repeated checks skip libgit2's repo discovery
+    global _repo
+    if _repo is None:
+        _repo = pygit2.Repository(PROJECT_DIR)
+    return _repo
+
+def git_line(*args):
+    """First line of a git command's output; only that line is ever buffered."""
+    with subprocess.Popen(['git', *args], stdout=subprocess.PIPE, cwd=PROJECT_DIR) as proc:
+        line = proc.stdout.readline().rstrip(b'\n').decode()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, ['git', *args])
+    return line
+
+def fetch_supports_depth():
+    # Shallow fetch (depth=) only exists in newer pygit2; older releases raise
+    # TypeError on the keyword, so those go straight to the git CLI
     try:
-        if not os.path.exists(PROJECT_DIR):
-            print(f"Error: Directory {PROJECT_DIR} does not exist.")
+        return 'depth' in inspect.signature(pygit2.Remote.fetch).parameters
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+PYGIT2_SHALLOW = pygit2 is not None and fetch_supports_depth()
+
+def remote_heads(remote):
+    # list_heads() replaced ls_remotes() in pygit2 1.15
+    if hasattr(remote, 'list_heads'):
+        return {head.name: str(head.oid) for head in remote.list_heads()}
+    return {head['name']: str(head['oid']) for head in remote.ls_remotes()}
+
+_head_cache = None  # ((HEAD mtime, branch ref mtime), hash)
+
+def head_stamp():
+    # Any commit, reset or checkout rewrites one of these two files
+    stamp = []
+    for name in ('HEAD', os.path.join('refs', 'heads', BRANCH)):
+        try:
+            stamp.append(os.stat(os.path.join(PROJECT_DIR, '.git', name)).st_mtime_ns)
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+def local_head():
+    """HEAD's hash, re-resolved only when HEAD or the branch ref changed on disk."""
+    global _head_cache
+    stamp = head_stamp()
+    if _head_cache is not None and _head_cache[0] == stamp:
+        return _head_cache[1]
+    if pygit2 is not None:
+        try:
+            head = str(open_repo().head.target)
+        except PYGIT2_ERRORS as e:
+            logger.warning(f"pygit2 failed ({e}), falling back to git CLI")
+            head = git_line('rev-parse', 'HEAD')
+    else:
+        head = git_line('rev-parse', 'HEAD')
+    _head_cache = (stamp, head)
+    return head
+
+def remote_tip():
+    """Ask origin for its branch tip.
+
+    Only the ref advertisement crosses the network; no objects are fetched
+    until we know there is something new.
+    """
+    if pygit2 is not None:
+        try:
+            return remote_heads(open_repo().remotes['origin'])[f'refs/heads/{BRANCH}']
+        except PYGIT2_ERRORS as e:
+            logger.warning(f"pygit2 failed ({e}), falling back to git CLI")
+
+    # ls-remote patterns match on trailing path components, so "main" would also
+    # hit refs/heads/feature/main; keep only the line naming our branch exactly
+    ref = f'refs/heads/{BRANCH}'
+    out = subprocess.check_output(['git', 'ls-remote', 'origin', ref], cwd=PROJECT_DIR)
+    # "<sha>\t<ref>" per line
+    for line in out.decode().splitlines():
+        remote_hash, _, name = line.partition('\t')
+        if name == ref:
+            return remote_hash
+    raise RuntimeError(f"origin has no branch {BRANCH}")
+
+def contains_commit(local_hash, remote_hash):
+    """True if HEAD already contains the remote tip (equal, or local is ahead)."""
+    if local_hash == remote_hash:
+        return True
+    if pygit2 is not None:
+        try:
+            repo = open_repo()
+            return repo.descendant_of(pygit2.Oid(hex=local_hash), pygit2.Oid(hex=remote_hash))
+        except (pygit2.GitError, KeyError, ValueError):
+            # Remote tip not in the local object store: we are behind
+            return False
+        except (AttributeError, TypeError) as e:
+            logger.warning(f"pygit2 failed ({e}), falling back to git CLI")
+    # Exit 0: ancestor; 1: not; 128: commit unknown locally, so also behind
+    result = subprocess.run(['git', 'merge-base', '--is-ancestor', remote_hash, local_hash],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=PROJECT_DIR)
+    return result.returncode == 0
+
+def fetch_and_reset():
+    # Tip commit only: no history is transferred and .git stays small on the SD card
+    refspec = f'+refs/heads/{BRANCH}:refs/remotes/origin/{BRANCH}'
+    if PYGIT2_SHALLOW:
+        try:
+            repo = open_repo()
+            repo.remotes['origin'].fetch([refspec], callbacks=pygit2.RemoteCallbacks(), depth=1)
+            target = repo.lookup_reference(f'refs/remotes/origin/{BRANCH}').target
+            repo.reset(target, pygit2.GIT_RESET_HARD)
             return
+        except PYGIT2_ERRORS as e:
+            logger.warning(f"pygit2 failed ({e}), falling back to git CLI")
+    # Progress and chatter go nowhere; stderr stays attached so failures still
+    # reach the journal
+    subprocess.run(['git', 'fetch', '--quiet', '--depth=1', 'origin', refspec],
+                   check=True, stdout=subprocess.DEVNULL, cwd=PROJECT_DIR)
+    subprocess.run(['git', 'reset', '--quiet', '--hard', f'origin/{BRANCH}'],
+                   check=True, stdout=subprocess.DEVNULL, cwd=PROJECT_DIR)
+
+def compact_repo():
+    # Each update strands the previous tip; --auto only repacks once enough
+    # loose objects pile up, so most calls return immediately
+    subprocess.run(['git', 'gc', '--auto', '--quiet'], check=False,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=PROJECT_DIR)
+
+def changed_files(old_hash, new_hash):
+    if pygit2 is not None:
+        try:
+            diff = open_repo().diff(old_hash, new_hash)
+            return {path for delta in diff.deltas for path in (delta.old_file.path, delta.new_file.path)}
+        except (*PYGIT2_ERRORS, ValueError) as e:
+            logger.warning(f"pygit2 failed ({e}), falling back to git CLI")
+    out = subprocess.check_output(['git', 'diff', '--name-only', old_hash, new_hash], cwd=PROJECT_DIR)
+    return set(out.decode().splitlines())
+
+def needs_restart(paths):
+    # Code, dependencies and Jinja templates (cached by Flask) are only picked
+    # up by a restart; docs, the installer and example config are not
+    return any(path.endswith('.py') or path == 'requirements.txt' or path.startswith('templates/')
+               for path in paths)
 
-        os.chdir(PROJECT_DIR)
-        
-        # 1. Fetch latest data from GitHub
-        subprocess.run(['git', 'fetch'], check=True)
-        
-        # 2. Compare local vs remote
-        local_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
-        remote_hash = subprocess.check_output(['git', 'rev-parse', 'origin/main']).decode().strip()
-        
-        if local_hash != remote_hash:
-            print("Changes detected. Backing up config.json and schedule.json...")
-            
-            # Backup both config and schedule so you don't lose show times or settings
-            subprocess.run(['cp', 'config.json', '/tmp/config.json.bak'], check=False)
-            subprocess.run(['cp', 'schedule.json', '/tmp/schedule.json.bak'], check=False)
-
-            print("Updating code from GitHub...")
+def read_local_settings():
+    # Held in memory across the reset: no cp processes and no /tmp copies
+    saved = {}
+    for name in PRESERVED_FILES:
+        try:
+            with open(os.path.join(PROJECT_DIR, name), 'rb') as f:
+                saved[name] = f.read()
+        except FileNotFoundError:
+            pass
+    return saved
+
+def restore_local_settings(saved):
+    # Untracked files normally survive the reset untouched; only rewrite one the
+    # reset removed or changed, and swap it in whole so the app never reads a
+    # half-written config
+    for name, data in saved.items():
+        path = os.path.join(PROJECT_DIR, name)
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    continue
+        except FileNotFoundError:
+            pass
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+def service_python():
+    # The interpreter the service runs (systemd ExecStart), whichever Python
+    # happens to be running the updater
+    venv_python = os.path.join(PROJECT_DIR, 'venv', 'bin', 'python')
+    return venv_python if os.path.exists(venv_python) else sys.executable
+
+def requirements_digest(python):
+    # Keyed on the target interpreter too: an install into another Python must
+    # not mark the venv as up to date
+    with open(os.path.join(PROJECT_DIR, 'requirements.txt'), 'rb') as f:
+        digest = hashlib.blake2b(f.read())
+    digest.update(python.encode())
+    return digest.hexdigest()
+
+def install_requirements():
+    python = service_python()
+    digest = requirements_digest(python)
+    try:
+        with open(REQUIREMENTS_HASH_FILE) as f:
+            if f.read().strip() == digest:
+                logger.info("Dependencies unchanged, skipping pip.")
+                return
+    except FileNotFoundError:
+        pass
+
+    logger.info("Updating dependencies...")
+    # uv resolves and installs natively, far faster than pip on the Pi's CPU.
+    # 'install', not 'sync': requirements.txt only pins top-level packages, and
+    # sync would uninstall their dependencies
+    if shutil.which('uv'):
+        cmd = ['uv', 'pip', 'install', '--python', python]
+    else:
+        cmd = [python, '-m', 'pip', 'install', '--disable-pip-version-check']
+    # A wheelhouse shipped next to the code (pip download -r requirements.txt -d wheels)
+    # makes the install offline: no index round trips, no sdist builds
+    if os.path.isdir(os.path.join(PROJECT_DIR, 'wheels')):
+        cmd += ['--no-index', '--find-links', 'wheels']
+    result = subprocess.run(cmd + ['--quiet', '-r', 'requirements.txt'], check=False,
+                            stdout=subprocess.DEVNULL, cwd=PROJECT_DIR)
+    if result.returncode == 0:
+        os.makedirs(STATE_DIR, mode=0o700, exist_ok=True)
+        with open(REQUIREMENTS_HASH_FILE, 'w') as f:
+            f.write(digest)
+
+def checked_recently():
+    try:
+        return time.time() - os.stat(LAST_CHECK_FILE).st_mtime < CHECK_INTERVAL_SEC
+    except FileNotFoundError:
+        return False
+
+def mark_checked():
+    with open(LAST_CHECK_FILE, 'a'):
+        pass
+    os.utime(LAST_CHECK_FILE)
+
+def update_from_remote():
+    # 1. Compare local vs the remote tip on GitHub. The common "nothing new"
+    # case costs one ls-remote and two stat() calls
+    local_hash = local_head()
+    remote_hash = remote_tip()
+
+    # A board with local commits on top of origin used to be reset back to it
+    if not contains_commit(local_hash, remote_hash):
+        logger.info("Changes detected. Backing up config.json and schedule.json...")
+
+        # Backup both config and schedule so you don't lose show times or settings
+        saved = read_local_settings()
+
+        try:
+            logger.info("Updating code from GitHub...")
             # This force-aligns your local code to match the GitHub repository exactly
-            subprocess.run(['git', 'reset', '--hard', 'origin/main'], check=True)
-
-            print("Restoring your local settings...")
-            subprocess.run(['cp', '/tmp/config.json.bak', 'config.json'], check=False)
-            subprocess.run(['cp', '/tmp/schedule.json.bak', 'schedule.json'], check=False)
-            
-            # 3. Handle Python Dependencies in case requirements.txt changed
-            print("Updating dependencies...")
-            subprocess.run(['pip', 'install', '-r', 'requirements.txt'], check=False)
-            
-            print(f"Restarting {SERVICE_NAME}...")
+            fetch_and_reset()
+        finally:
+            # Only copy is in memory, so put it back even if the update failed
+            logger.info("Restoring your local settings...")
+            restore_local_settings(saved)
+
+        # 3. Handle Python Dependencies in case requirements.txt changed
+        install_requirements()
+        compact_repo()
+
+        # Restarting drops the serial stream and misses cars, so only do it
+        # when something the running service uses has changed
+        try:
+            restart = needs_restart(changed_files(local_hash, 'HEAD'))
+        except Exception as e:
+            logger.warning(f"Could not list changed files ({e}), restarting to be safe")
+            restart = True
+        if restart:
+            logger.info(f"Restarting {SERVICE_NAME}...")
             # Removed 'sudo' since Orange Pi runs this as root
-            subprocess.run(['systemctl', 'restart', SERVICE_NAME], check=False)
-            
-            print("Update successful!")
+            # Own session, so the restart completes even if it stops our caller
+            subprocess.run(['systemctl', 'restart', SERVICE_NAME], check=False,
+                           stdout=subprocess.DEVNULL, start_new_session=True)
         else:
-            print("Already up to date.")
-            
+            logger.info("No code changes, service left running.")
+
+        logger.info("Update successful!")
+    else:
+        logger.info("Already up to date.")
+
+def check_for_updates(force=False):
+    """Update to the remote branch if it moved. Returns False if the check failed."""
+    try:
+        if not os.path.exists(PROJECT_DIR):
+            logger.error(f"Directory {PROJECT_DIR} does not exist.")
+            return False
+
+        if not force and checked_recently():
+            logger.info("Checked for updates recently, skipping.")
+            return True
+
+        # Cross-process guard (cron, --watch, a manual run): a second updater
+        # walks away instead of repeating the fetch, reset and pip
+        os.makedirs(STATE_DIR, mode=0o700, exist_ok=True)
+        lock_fd = os.open(LOCK_FILE, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info("Another update is in progress, skipping.")
+                return True
+            update_from_remote()
+        finally:
+            os.close(lock_fd)
+        mark_checked()
+        return True
+
     except Exception as e:
-        print(f"Update failed: {e}")
+        logger.error(f"Update failed: {e}")
+        return False
+
+def update_scheduler_loop(interval):
+    failures = 0
+    while True:
+        failures = 0 if check_for_updates() else failures + 1
+        time.sleep(min(MAX_BACKOFF_SEC, interval * 2 ** failures))
+
+def start_update_scheduler(interval=CHECK_INTERVAL_SEC):
+    """Check for updates periodically on a daemon thread, off any request path."""
+    thread = threading.Thread(target=update_scheduler_loop, args=(interval,), name='updater', daemon=True)
+    thread.start()
+    return thread
 
 if __name__ == "__main__":
-    check_for_updates()
+    # Configure logging to match your app.py style
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    # --watch: keep checking in the foreground; --force: ignore the recent-check marker
+    args = sys.argv[1:]
+    if '--watch' in args:
+        start_update_scheduler().join()
+    else:
+        check_for_updates(force='--force' in args)
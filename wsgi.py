@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+# WSGI entry point for running under a production server, e.g.:
+#   gunicorn -w 1 --threads 4 --bind unix:/run/lidar.sock wsgi:app
+# Keep it to ONE worker process: every worker would open the lidar serial port
+# and start its own DB writer.
+from app import app, start_services
+
+start_services()